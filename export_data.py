@@ -1,20 +1,25 @@
 # export_events_with_balances.py
-from decimal import Decimal
+from decimal import Decimal, getcontext
 import csv
+import io
 import sys
 import argparse
 import shutil
-from typing import Dict, List, Optional
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import ContextManager, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
 
 from bittytax.bittytax import _do_import, _do_tax
 from bittytax.audit import AuditRecords, AuditLogEntry
-from bittytax.bt_types import TaxRules, TrType
+from bittytax.bt_types import TaxRules, TrRecordPart, TrType
 from bittytax.tax_event import TaxEventCapitalGains as TECG
 from bittytax.tax import CalculateCapitalGains as CCG
 from bittytax.t_record import TransactionRecord
 
 INPUT = "pablo-data/all_records_250713.xlsx"  # change to your file
 TAX_RULES = TaxRules.UK_INDIVIDUAL  # or a UK_COMPANY_* rule
+CSV_BUFFER_SIZE = 1 << 20  # bytes buffered before each write to stdout
+CSV_BATCH_ROWS = 4096  # CSV lines joined per write
 
 # Monkey-patch to tag capital gains events with the originating transaction record and tid
 _orig_init_cg = TECG.__init__
@@ -28,6 +33,14 @@ def _patched_init_cg(self, disposal_type, b, s, cost, fees):
 
 TECG.__init__ = _patched_init_cg  # type: ignore[assignment]
 
+# Enum members are singletons, so parts are compared by identity
+_BUY = TrRecordPart.BUY
+_SELL = TrRecordPart.SELL
+
+_D0 = Decimal(0)
+# Starting [proceeds, cost, fees, gain] totals for a record, copied per new record
+_PL_TEMPLATE = [_D0, _D0, _D0, _D0]
+
 INCOME_TYPES = {
     TrType.MINING,
     TrType.STAKING,
@@ -36,17 +49,117 @@ INCOME_TYPES = {
     TrType.INCOME,
 }
 
-
-def fmt_qty(x: Optional[Decimal]) -> str:
-    return "" if x is None else f"{x.normalize():f}"
-
-
-def fmt_val(x: Optional[Decimal]) -> str:
-    return "" if x is None else f"{x:.2f}"
+HEADERS = [
+    "asset",
+    "timestamp",
+    "record_type",  # e.g., Trade, Spend, Income, Staking
+    "part",  # BUY / SELL / FEE
+    "wallet",
+    "change_qty",  # asset units (+ for BUY, - for SELL)
+    "fee_qty",  # asset units (fee paid in this asset)
+    "balance_wallet_after",  # asset units
+    "total_balance_after",  # asset units, across wallets
+    "sell_proceeds_value_ccy",  # reporting currency
+    "sell_cost_value_ccy",  # reporting currency
+    "sell_fees_value_ccy",  # reporting currency
+    "sell_gain_value_ccy",  # reporting currency
+    "income_amount_value_ccy",  # reporting currency (for income-type BUY)
+    "income_fees_value_ccy",  # reporting currency (for income-type BUY)
+    "counter_asset",  # asset spent/received on the other side of the record
+    "counter_change_qty",  # counter asset units (sign reflects its own event)
+    "counter_balance_wallet_after",  # counter asset wallet balance after its own event
+    "counter_total_balance_after",  # counter asset total balance after its own event
+    "tx",
+]
+
+# Output column positions, looked up by name so row assembly can't drift from HEADERS
+_COL_ASSET = HEADERS.index("asset")
+_COL_TIMESTAMP = HEADERS.index("timestamp")
+_COL_RECORD_TYPE = HEADERS.index("record_type")
+_COL_PART = HEADERS.index("part")
+_COL_WALLET = HEADERS.index("wallet")
+_COL_CHANGE_QTY = HEADERS.index("change_qty")
+_COL_FEE_QTY = HEADERS.index("fee_qty")
+_COL_BALANCE = HEADERS.index("balance_wallet_after")
+_COL_TOTAL = HEADERS.index("total_balance_after")
+_COL_SELL_PROCEEDS = HEADERS.index("sell_proceeds_value_ccy")
+_COL_SELL_COST = HEADERS.index("sell_cost_value_ccy")
+_COL_SELL_FEES = HEADERS.index("sell_fees_value_ccy")
+_COL_SELL_GAIN = HEADERS.index("sell_gain_value_ccy")
+_COL_INCOME_AMOUNT = HEADERS.index("income_amount_value_ccy")
+_COL_INCOME_FEES = HEADERS.index("income_fees_value_ccy")
+_COL_COUNTER_ASSET = HEADERS.index("counter_asset")
+_COL_COUNTER_CHANGE_QTY = HEADERS.index("counter_change_qty")
+_COL_COUNTER_BALANCE = HEADERS.index("counter_balance_wallet_after")
+_COL_COUNTER_TOTAL = HEADERS.index("counter_total_balance_after")
+_COL_TX = HEADERS.index("tx")
+
+
+@dataclass
+class FmtCaches:
+    # Per-run caches, created in main() so nothing outlives the records being exported
+    qty: Dict[Decimal, str] = field(default_factory=dict)
+    neg_qty: Dict[Decimal, str] = field(default_factory=dict)
+    val: Dict[Decimal, str] = field(default_factory=dict)
+    ts: Dict[int, str] = field(default_factory=dict)
+
+
+def _format_qty(x: Decimal) -> str:
+    if not x:
+        return "-0" if x.is_signed() else "0"
+    t = x.as_tuple()
+    if isinstance(t.exponent, int) and 0 <= t.exponent <= getcontext().prec - len(t.digits):
+        # Integer-valued (e.g. whole coins) with at most prec digits in total, so normalize()
+        # wouldn't round and str(int()) stays far below the int string conversion limit
+        return str(int(x))
+    return f"{x.normalize():f}"
+
+
+def fmt_qty(x: Optional[Decimal], cache: Optional[Dict[Decimal, str]] = None) -> str:
+    # Only pass a cache for values that repeat (quantities, fees), not running balances
+    if x is None:
+        return ""
+    if cache is None:
+        return _format_qty(x)
+    r = cache.get(x)
+    if r is None:
+        r = _format_qty(x)
+        if x:
+            # 0 and -0 compare (and hash) equal, so keep them out of the cache
+            cache[x] = r
+    return r
+
+
+def fmt_neg_qty(x: Decimal, cache: Dict[Decimal, str]) -> str:
+    # Same as fmt_qty(-x), but cached on x so a hit doesn't allocate the negated Decimal
+    r = cache.get(x)
+    if r is None:
+        r = _format_qty(-x)
+        if x:
+            cache[x] = r
+    return r
+
+
+def fmt_val(x: Optional[Decimal], cache: Optional[Dict[Decimal, str]] = None) -> str:
+    if x is None:
+        return ""
+    r = cache.get(x) if cache is not None else None
+    if r is None:
+        if not x:
+            return "-0.00" if x.is_signed() else "0.00"
+        r = f"{x:.2f}"
+        if cache is not None:
+            cache[x] = r
+    return r
 
 
-def ts(tr: TransactionRecord) -> str:
-    return tr._format_timestamp()
+def ts(tr: TransactionRecord, cache: Dict[int, str]) -> str:
+    # Cache is keyed by id(), so it must not outlive the records it was filled from
+    k = id(tr)
+    v = cache.get(k)
+    if v is None:
+        v = cache[k] = tr._format_timestamp()
+    return v
 
 
 def _should_output_csv(force_csv: bool, force_table: bool) -> bool:
@@ -58,8 +171,30 @@ def _should_output_csv(force_csv: bool, force_table: bool) -> bool:
     return not sys.stdout.isatty()
 
 
+def _csv_output() -> ContextManager[TextIO]:
+    # Stream rows as they are built through a large buffer on the stdout descriptor
+    sys.stdout.flush()
+    try:
+        fd = sys.stdout.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        # Replaced stdout (e.g. io.StringIO) with no real descriptor, write to it as-is
+        return nullcontext(sys.stdout)
+    return open(
+        fd,
+        "w",
+        buffering=CSV_BUFFER_SIZE,
+        encoding=sys.stdout.encoding,
+        errors=sys.stdout.errors,
+        closefd=False,
+    )
+
+
 def fmt_tx(tr: TransactionRecord) -> str:
-    txr = getattr(getattr(tr, "t_row", None), "tx_raw", None)
+    try:
+        txr = tr.t_row.tx_raw
+    except AttributeError:
+        # No source row (t_row is None) or the row carries no raw tx details
+        return ""
     if not txr:
         return ""
     if txr.tx_hash:
@@ -76,6 +211,42 @@ def fmt_tx(tr: TransactionRecord) -> str:
     return ""
 
 
+_csv_field_buf = io.StringIO()
+_csv_field_writer = csv.writer(_csv_field_buf, lineterminator="\n")
+
+
+def _csv_escape(text: str) -> str:
+    # Fields with special characters are rare, let csv.writer quote them so both paths agree
+    if any(c in text for c in ',"\r\n'):
+        _csv_field_buf.seek(0)
+        _csv_field_buf.truncate()
+        _csv_field_writer.writerow([text])
+        return _csv_field_buf.getvalue()[:-1]
+    return text
+
+
+def _write_csv(out: TextIO, headers: List[str], rows: Iterable[List[str]]) -> None:
+    # Free-text columns come from the import as-is and may need quoting; the rest are
+    # numbers, timestamps and enum values formatted by us
+    escape_indices = [
+        headers.index(name)
+        for name in ("asset", "wallet", "counter_asset", "tx")
+        if name in headers
+    ]
+    # Lines are joined into batches so each write (and encode) covers many rows
+    lines = [",".join(headers)]
+    append = lines.append
+    for row in rows:
+        for i in escape_indices:
+            row[i] = _csv_escape(row[i])
+        append(",".join(row))
+        if len(lines) >= CSV_BATCH_ROWS:
+            out.write("\n".join(lines) + "\n")
+            lines.clear()
+    if lines:
+        out.write("\n".join(lines) + "\n")
+
+
 def _truncate_cell(text: str, max_width: int) -> str:
     if len(text) <= max_width:
         return text
@@ -108,17 +279,11 @@ def _print_ascii_table(headers: List[str], rows: List[List[str]]) -> None:
         18,  # counter_total_balance_after
     }
 
-    # Truncate cells with a preliminary cap to bound computation
-    prelim_rows: List[List[str]] = []
-    for r in rows:
-        prelim_rows.append([_truncate_cell(c, soft_cap) for c in r])
-
-    # Compute widths
-    widths: List[int] = []
-    for col_idx, header in enumerate(headers):
-        col_items = [row[col_idx] for row in prelim_rows] if prelim_rows else []
-        max_len = max([len(header)] + [len(x) for x in col_items])
-        widths.append(max_len)
+    # Compute widths from raw cell lengths, with cells clamped to the soft cap
+    cols = list(zip(*rows)) if rows else [()] * len(headers)
+    widths = [
+        max(len(h), min(max(map(len, col), default=0), soft_cap)) for h, col in zip(headers, cols)
+    ]
 
     # If the table is too wide, reduce columns down to a minimum
     # Total = sum(widths) + 3 * (ncols - 1) (separators); use 1 space padding around |
@@ -138,29 +303,95 @@ def _print_ascii_table(headers: List[str], rows: List[List[str]]) -> None:
             widths[widest_idx] -= 1
             over_by -= 1
 
-        # Apply final truncation to cells per new widths
-        prelim_rows = [
-            [_truncate_cell(cell, widths[i]) for i, cell in enumerate(row)] for row in prelim_rows
-        ]
+    # Truncate cells once, to the final width (never beyond the soft cap)
+    caps = [min(w, soft_cap) for w in widths]
+    prelim_rows = [[_truncate_cell(cell, caps[i]) for i, cell in enumerate(row)] for row in rows]
 
-    # Builders
-    def fmt_cell(text: str, width: int, right_align: bool) -> str:
-        if right_align:
-            return text.rjust(width)
-        return text.ljust(width)
+    # Row template fixes each column's alignment and width up front
+    aligns = [">" if i in numeric_indices else "<" for i in range(len(headers))]
+    row_fmt = " " + " | ".join(f"{{:{a}{w}}}" for a, w in zip(aligns, widths)) + "\n"
 
-    # Header
-    header_cells = [fmt_cell(h, widths[i], False) for i, h in enumerate(headers)]
-    header_line = " | ".join(header_cells)
-    sep_line = "-+-".join(["-" * widths[i] for i in range(len(headers))])
+    # Build the whole table in memory and emit it with a single write
+    buf = io.StringIO()
+    write = buf.write
 
-    print(" " + header_line)
-    print(" " + sep_line)
+    # Header
+    write(" " + " | ".join(h.ljust(w) for h, w in zip(headers, widths)) + "\n")
+    write(" " + "-+-".join("-" * w for w in widths) + "\n")
 
     # Rows
     for row in prelim_rows:
-        cells = [fmt_cell(row[i], widths[i], i in numeric_indices) for i in range(len(headers))]
-        print(" " + " | ".join(cells))
+        write(row_fmt.format(*row))
+
+    sys.stdout.write(buf.getvalue())
+
+
+def _build_row(
+    asset: str,
+    e: AuditLogEntry,
+    tr_to_pl: Dict[int, List[Decimal]],
+    tr_to_entries: Dict[Tuple[int, TrRecordPart], AuditLogEntry],
+    caches: FmtCaches,
+) -> List[str]:
+    tr = e.t_record
+    tid0 = tr.tid[0] if tr.tid else None
+    part = e.tr_part
+    buy = tr.buy
+    sell = tr.sell
+    t_type = tr.t_type
+
+    # One list per row: base event fields, then the optional columns by name
+    row = [""] * len(HEADERS)
+    row[_COL_ASSET] = asset
+    row[_COL_TIMESTAMP] = ts(tr, caches.ts)
+    row[_COL_RECORD_TYPE] = t_type.value
+    row[_COL_PART] = part.value
+    row[_COL_WALLET] = e.wallet
+    row[_COL_CHANGE_QTY] = fmt_qty(e.change, caches.qty)
+    row[_COL_FEE_QTY] = fmt_qty(e.fee, caches.qty)
+    row[_COL_BALANCE] = fmt_qty(e.balance)
+    row[_COL_TOTAL] = fmt_qty(e.total)
+    row[_COL_TX] = fmt_tx(tr)
+
+    # SELL P/L (if any) aggregated per transaction
+    if part is _SELL and tid0 is not None:
+        pl = tr_to_pl.get(tid0)
+        if pl:
+            row[_COL_SELL_PROCEEDS] = fmt_val(pl[0])
+            row[_COL_SELL_COST] = fmt_val(pl[1])
+            row[_COL_SELL_FEES] = fmt_val(pl[2])
+            row[_COL_SELL_GAIN] = fmt_val(pl[3])
+
+    # INCOME amounts (for income-type BUY)
+    if part is _BUY and t_type in INCOME_TYPES and buy:
+        row[_COL_INCOME_AMOUNT] = fmt_val(buy.cost if buy.cost is not None else None, caches.val)
+        row[_COL_INCOME_FEES] = fmt_val(
+            buy.fee_value if buy.fee_value is not None else None, caches.val
+        )
+
+    # Counter asset info (currency used on the other side), amount and its balances
+    if tid0 is not None:
+        if part is _BUY:
+            # Other side is SELL (amount spent to acquire this BUY)
+            if sell:
+                row[_COL_COUNTER_ASSET] = sell.asset
+                row[_COL_COUNTER_CHANGE_QTY] = fmt_neg_qty(sell.quantity, caches.neg_qty)
+            sell_e = tr_to_entries.get((tid0, _SELL))
+            if sell_e:
+                row[_COL_COUNTER_BALANCE] = fmt_qty(sell_e.balance)
+                row[_COL_COUNTER_TOTAL] = fmt_qty(sell_e.total)
+        elif part is _SELL:
+            # Other side is BUY (amount received from this SELL)
+            if buy:
+                row[_COL_COUNTER_ASSET] = buy.asset
+                row[_COL_COUNTER_CHANGE_QTY] = fmt_qty(buy.quantity, caches.qty)
+            buy_e = tr_to_entries.get((tid0, _BUY))
+            if buy_e:
+                row[_COL_COUNTER_BALANCE] = fmt_qty(buy_e.balance)
+                row[_COL_COUNTER_TOTAL] = fmt_qty(buy_e.total)
+        # FEE has no counter
+
+    return row
 
 
 def main():
@@ -169,6 +400,11 @@ def main():
     )
     parser.add_argument("--csv", action="store_true", help="Force CSV output to stdout")
     parser.add_argument("--table", action="store_true", help="Force ASCII table output to stdout")
+    parser.add_argument(
+        "--strict-csv",
+        action="store_true",
+        help="Write CSV using the csv module, quoting any field that needs it",
+    )
     parser.add_argument("--input", default=INPUT, help="Path to BittyTax input workbook (.xlsx)")
     args = parser.parse_args()
 
@@ -181,149 +417,50 @@ def main():
     tax, _ = _do_tax(trs, TAX_RULES, skip_integrity_check=True)
 
     # Aggregate disposal P/L per TransactionRecord using the stable main TID (tid[0])
-    tr_to_pl: Dict[int, Dict[str, Decimal]] = {}
-    for year in sorted(tax.tax_events):
-        if year not in CCG.CG_DATA_INDIVIDUAL:
-            continue
+    # Each value is [proceeds, cost, fees, gain] (indices 0..3)
+    tr_to_pl: Dict[int, List[Decimal]] = {}
+    for year in sorted(set(tax.tax_events) & set(CCG.CG_DATA_INDIVIDUAL)):
         for te in tax.tax_events[year]:
             if getattr(te, "t_record", None) is None:
                 continue
             tr = te.t_record
             if tr.tid:
                 tr_key = tr.tid[0]
-                agg = tr_to_pl.setdefault(
-                    tr_key,
-                    {
-                        "proceeds": Decimal(0),
-                        "cost": Decimal(0),
-                        "fees": Decimal(0),
-                        "gain": Decimal(0),
-                    },
-                )
-                agg["proceeds"] += te.proceeds
-                agg["cost"] += te.cost
-                agg["fees"] += te.fees
-                agg["gain"] += te.gain
+                agg = tr_to_pl.get(tr_key)
+                if agg is None:
+                    agg = tr_to_pl[tr_key] = _PL_TEMPLATE.copy()
+                agg[0] += te.proceeds
+                agg[1] += te.cost
+                agg[2] += te.fees
+                agg[3] += te.gain
 
     # Map each TransactionRecord (by tid[0]) to its own audit entries (BUY/SELL/FEE)
-    tr_to_entries: Dict[int, Dict[str, AuditLogEntry]] = {}
+    tr_to_entries: Dict[Tuple[int, TrRecordPart], AuditLogEntry] = {}
     for asset, entries in audit.audit_log.items():
         for e in entries:
-            tr = e.t_record
-            if tr.tid:
-                key = tr.tid[0]
-                parts = tr_to_entries.setdefault(key, {})
-                parts[e.tr_part.name] = e  # "BUY", "SELL", "FEE"
-
-    headers = [
-        "asset",
-        "timestamp",
-        "record_type",  # e.g., Trade, Spend, Income, Staking
-        "part",  # BUY / SELL / FEE
-        "wallet",
-        "change_qty",  # asset units (+ for BUY, - for SELL)
-        "fee_qty",  # asset units (fee paid in this asset)
-        "balance_wallet_after",  # asset units
-        "total_balance_after",  # asset units, across wallets
-        "sell_proceeds_value_ccy",  # reporting currency
-        "sell_cost_value_ccy",  # reporting currency
-        "sell_fees_value_ccy",  # reporting currency
-        "sell_gain_value_ccy",  # reporting currency
-        "income_amount_value_ccy",  # reporting currency (for income-type BUY)
-        "income_fees_value_ccy",  # reporting currency (for income-type BUY)
-        "counter_asset",  # asset spent/received on the other side of the record
-        "counter_change_qty",  # counter asset units (sign reflects its own event)
-        "counter_balance_wallet_after",  # counter asset wallet balance after its own event
-        "counter_total_balance_after",  # counter asset total balance after its own event
-        "tx",
-    ]
+            tid = e.t_record.tid
+            if tid:
+                tr_to_entries[(tid[0], e.tr_part)] = e  # BUY, SELL, FEE
 
-    data_rows: List[List[str]] = []
-    for asset in sorted(audit.audit_log):
-        for e in audit.audit_log[asset]:
-            tr = e.t_record
-            record_type = tr.t_type.value
-
-            # Base event fields
-            row = [
-                asset,
-                ts(tr),
-                record_type,
-                e.tr_part.value,
-                e.wallet,
-                fmt_qty(e.change),
-                fmt_qty(e.fee),
-                fmt_qty(e.balance),
-                fmt_qty(e.total),
-            ]
-
-            # SELL P/L (if any) aggregated per transaction
-            sell_cols = ["", "", "", ""]
-            if e.tr_part.name == "SELL" and tr.tid:
-                tr_key = tr.tid[0]
-                pl = tr_to_pl.get(tr_key)
-                if pl:
-                    sell_cols = [
-                        fmt_val(pl["proceeds"]),
-                        fmt_val(pl["cost"]),
-                        fmt_val(pl["fees"]),
-                        fmt_val(pl["gain"]),
-                    ]
-
-            # INCOME amounts (for income-type BUY)
-            income_cols = ["", ""]
-            if e.tr_part.name == "BUY" and tr.t_type in INCOME_TYPES and tr.buy:
-                income_cols = [
-                    fmt_val(tr.buy.cost if tr.buy.cost is not None else None),
-                    fmt_val(tr.buy.fee_value if tr.buy.fee_value is not None else None),
-                ]
-
-            # Counter asset info (currency used on the other side), amount and that side's balances
-            counter_asset = ""
-            counter_change_qty = ""
-            counter_wallet_bal_after = ""
-            counter_total_bal_after = ""
+    # Flatten the per-asset logs once; output is ordered by asset (insertion order is not)
+    all_events = [(asset, e) for asset, entries in sorted(audit.audit_log.items()) for e in entries]
 
-            if tr.tid:
-                tr_key = tr.tid[0]
-                parts = tr_to_entries.get(tr_key, {})
-                if e.tr_part.name == "BUY":
-                    # Other side is SELL (amount spent to acquire this BUY)
-                    if tr.sell:
-                        counter_asset = tr.sell.asset
-                        counter_change_qty = fmt_qty(-tr.sell.quantity)
-                    if "SELL" in parts:
-                        counter_wallet_bal_after = fmt_qty(parts["SELL"].balance)
-                        counter_total_bal_after = fmt_qty(parts["SELL"].total)
-                elif e.tr_part.name == "SELL":
-                    # Other side is BUY (amount received from this SELL)
-                    if tr.buy:
-                        counter_asset = tr.buy.asset
-                        counter_change_qty = fmt_qty(tr.buy.quantity)
-                    if "BUY" in parts:
-                        counter_wallet_bal_after = fmt_qty(parts["BUY"].balance)
-                        counter_total_bal_after = fmt_qty(parts["BUY"].total)
-                # FEE has no counter
-
-            data_rows.append(
-                row
-                + sell_cols
-                + income_cols
-                + [
-                    counter_asset,
-                    counter_change_qty,
-                    counter_wallet_bal_after,
-                    counter_total_bal_after,
-                    fmt_tx(tr),
-                ]
-            )
+    caches = FmtCaches()
+
+    def iter_rows() -> Iterator[List[str]]:
+        for asset, e in all_events:
+            yield _build_row(asset, e, tr_to_pl, tr_to_entries, caches)
 
     if _should_output_csv(force_csv=args.csv, force_table=args.table):
-        writer = csv.writer(sys.stdout, lineterminator="\n")
-        writer.writerow(headers)
-        writer.writerows(data_rows)
+        with _csv_output() as out:
+            if args.strict_csv:
+                writer = csv.writer(out, lineterminator="\n")
+                writer.writerow(HEADERS)
+                writer.writerows(iter_rows())
+            else:
+                _write_csv(out, HEADERS, iter_rows())
     else:
-        _print_ascii_table(headers, data_rows)
+        _print_ascii_table(HEADERS, list(iter_rows()))
 
 
 if __name__ == "__main__":
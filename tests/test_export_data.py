@@ -0,0 +1,186 @@
+import csv
+import io
+import itertools
+import os
+import sys
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+from bittytax.audit import AuditLogEntry
+from bittytax.bt_types import AssetSymbol, Note, Timestamp, TrRecordPart, TrType, Wallet
+from bittytax.t_record import TransactionRecord
+from bittytax.transactions import Buy, Sell
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# pylint: disable=wrong-import-position
+from export_data import HEADERS, FmtCaches, _build_row, _write_csv, fmt_qty  # noqa: E402
+
+CSV_HEADERS = ["asset", "wallet", "change_qty", "counter_asset", "tx"]
+
+
+def _csv_module(rows: List[List[str]]) -> str:
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(CSV_HEADERS)
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+def test_write_csv_matches_csv_module() -> None:
+    awkward = ["", "plain", "a,b", 'say "hi"', "line\nbreak", "w\r", "\r\n", '",\n\r']
+    # Every free-text column: asset, wallet, counter_asset and tx
+    rows = [
+        [asset, wallet, "1.5", counter, tx]
+        for asset, wallet, counter, tx in itertools.product(awkward, repeat=4)
+    ]
+
+    out = io.StringIO()
+    _write_csv(out, CSV_HEADERS, [list(row) for row in rows])
+
+    assert out.getvalue() == _csv_module(rows)
+
+
+def test_fmt_qty_matches_normalize() -> None:
+    for value in [
+        "0",
+        "-0",
+        "7",
+        "-5",
+        "100",
+        "1E+2",
+        "1.50",
+        "0.00100",
+        "9" * 28,
+        "1" * 32,
+        "1E+5000",
+    ]:
+        x = Decimal(value)
+        assert fmt_qty(x) == f"{x.normalize():f}"
+
+
+def _trade_entries() -> List[Tuple[str, AuditLogEntry, Dict[str, str]]]:
+    wallet = Wallet("Kraken")
+    tr = TransactionRecord(
+        TrType.TRADE,
+        Buy(TrType.TRADE, Decimal(2), AssetSymbol("BTC"), Decimal(20000)),
+        Sell(TrType.TRADE, Decimal(20000), AssetSymbol("GBP"), Decimal(20000)),
+        Sell(TrType.SPEND, Decimal("0.001"), AssetSymbol("BTC"), Decimal(10)),
+        wallet,
+        Timestamp(datetime(2023, 1, 2, 3, 4, 5, tzinfo=timezone.utc)),
+        Note(""),
+        None,  # type: ignore[arg-type]
+    )
+    tr.tid = [7, 0]
+    income = TransactionRecord(
+        TrType.STAKING,
+        Buy(TrType.STAKING, Decimal("0.5"), AssetSymbol("ETH"), Decimal("812.5")),
+        None,
+        None,
+        wallet,
+        Timestamp(datetime(2023, 1, 3, 0, 0, 0, tzinfo=timezone.utc)),
+        Note(""),
+        None,  # type: ignore[arg-type]
+    )
+    income.tid = [8, 0]
+
+    def entry(
+        part: TrRecordPart,
+        t_record: TransactionRecord,
+        change: Optional[Decimal],
+        fee: Optional[Decimal],
+        balance: str,
+        total: str,
+    ) -> AuditLogEntry:
+        return AuditLogEntry(
+            change, fee, Decimal(balance), Decimal(0), wallet, Decimal(total), part, t_record
+        )
+
+    return [
+        (
+            "BTC",
+            entry(TrRecordPart.BUY, tr, Decimal(2), None, "2.5", "3"),
+            {
+                "asset": "BTC",
+                "timestamp": "2023-01-02T03:04:05 UTC",
+                "record_type": "Trade",
+                "part": "Buy",
+                "wallet": "Kraken",
+                "change_qty": "2",
+                "balance_wallet_after": "2.5",
+                "total_balance_after": "3",
+                "counter_asset": "GBP",
+                "counter_change_qty": "-20000",
+                "counter_balance_wallet_after": "5000",
+                "counter_total_balance_after": "5000",
+            },
+        ),
+        (
+            "GBP",
+            entry(TrRecordPart.SELL, tr, Decimal(-20000), None, "5000", "5000.00"),
+            {
+                "asset": "GBP",
+                "timestamp": "2023-01-02T03:04:05 UTC",
+                "record_type": "Trade",
+                "part": "Sell",
+                "wallet": "Kraken",
+                "change_qty": "-20000",
+                "balance_wallet_after": "5000",
+                "total_balance_after": "5000",
+                "sell_proceeds_value_ccy": "20000.00",
+                "sell_cost_value_ccy": "15000.00",
+                "sell_fees_value_ccy": "10.00",
+                "sell_gain_value_ccy": "4990.00",
+                "counter_asset": "BTC",
+                "counter_change_qty": "2",
+                "counter_balance_wallet_after": "2.5",
+                "counter_total_balance_after": "3",
+            },
+        ),
+        (
+            "BTC",
+            entry(TrRecordPart.FEE, tr, None, Decimal("-0.001"), "2.499", "2.999"),
+            {
+                "asset": "BTC",
+                "timestamp": "2023-01-02T03:04:05 UTC",
+                "record_type": "Trade",
+                "part": "Fee",
+                "wallet": "Kraken",
+                "fee_qty": "-0.001",
+                "balance_wallet_after": "2.499",
+                "total_balance_after": "2.999",
+            },
+        ),
+        (
+            "ETH",
+            entry(TrRecordPart.BUY, income, Decimal("0.5"), None, "0.5", "0.5"),
+            {
+                "asset": "ETH",
+                "timestamp": "2023-01-03T00:00:00 UTC",
+                "record_type": "Staking",
+                "part": "Buy",
+                "wallet": "Kraken",
+                "change_qty": "0.5",
+                "balance_wallet_after": "0.5",
+                "total_balance_after": "0.5",
+                "income_amount_value_ccy": "812.50",
+            },
+        ),
+    ]
+
+
+def test_build_row_columns() -> None:
+    entries = _trade_entries()
+    tr_to_pl = {7: [Decimal(20000), Decimal(15000), Decimal(10), Decimal(4990)]}
+    tr_to_entries = {}
+    for _, e, _ in entries:
+        assert e.t_record.tid
+        tr_to_entries[(e.t_record.tid[0], e.tr_part)] = e
+
+    caches = FmtCaches()
+    for asset, e, expected in entries:
+        row = _build_row(asset, e, tr_to_pl, tr_to_entries, caches)
+
+        assert len(row) == len(HEADERS)
+        assert dict(zip(HEADERS, row)) == {name: expected.get(name, "") for name in HEADERS}